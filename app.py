@@ -3,19 +3,24 @@ Flask Application for AI Brain Hemorrhage Detection System
 Two-stage deep learning pipeline with Grad-CAM visualization
 """
 
-from flask import Flask, render_template, request, jsonify, send_from_directory, session
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, session
 import os
 from pathlib import Path
 from werkzeug.utils import secure_filename
 import uuid
+import time
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import traceback
+import orjson
+from waitress import serve
 
 # Import our custom modules
-from model_utils import load_models, get_model_info
-from inference import run_full_pipeline, format_results_for_display
-from gradcam import generate_gradcam_for_subtypes
-from PIL import Image
+from model_utils import COMPILE_BATCH_SIZES, load_models, get_model_info
+from inference import preprocess_image, format_results_for_display
+from gradcam import render_gradcam_for_subtypes
+from batching import DynamicBatcher
 import cv2
 
 # Initialize Flask app
@@ -35,31 +40,88 @@ RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = str(UPLOAD_FOLDER)
 app.config['RESULTS_FOLDER'] = str(RESULTS_FOLDER)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.json.sort_keys = False  # keep result dicts in insertion order, skip the sort
+
+# Production server: one process, many request threads. GPU work is
+# serialized by the DynamicBatcher worker, so no model lock is needed.
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5000
+SERVER_THREADS = 8
+
+# Dynamic batching of concurrent analyze requests
+BATCH_MAX_SIZE = 16
+BATCH_MAX_WAIT_MS = 10
+INFERENCE_TIMEOUT_S = 30
+
+# Background threads for Grad-CAM PNG encoding/writing
+IO_POOL = ThreadPoolExecutor(max_workers=4)
+PNG_COMPRESSION = 3  # faster than the default 6, similar size for heatmaps
+
+# Old uploads/results are removed periodically, not per request
+CLEANUP_INTERVAL_S = 15 * 60
 
 # Load models on startup
 print("Loading AI models...")
 try:
-    detector_model, classifier_model, device = load_models()
+    # Warmed up on the batcher's worker thread instead (CUDA graphs are per thread)
+    detector_model, classifier_model, device = load_models(warmup=False)
+    batcher = DynamicBatcher(detector_model, classifier_model, device,
+                             max_batch=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+    try:
+        batcher.warmup(COMPILE_BATCH_SIZES if device.type == 'cuda' else (1,))
+    except Exception as e:
+        print(f"⚠ Warm-up failed: {e}")
     print("✓ Models loaded successfully!")
 except Exception as e:
     print(f"❌ Error loading models: {e}")
     detector_model = None
     classifier_model = None
     device = None
+    batcher = None
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_png(path, rgb_image):
+    """Encode an RGB image as PNG and write it (runs on IO_POOL)"""
+    try:
+        bgr_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
+        ok, encoded = cv2.imencode('.png', bgr_image, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+        if not ok:
+            raise RuntimeError('PNG encoding failed')
+        # tofile instead of cv2.imwrite so non-ASCII paths work on Windows
+        encoded.tofile(str(path))
+    except Exception as e:
+        print(f"❌ Could not save {path}: {e}")
+
+def json_response(payload, status=200):
+    """Serialize a response payload with orjson (faster than jsonify)"""
+    return Response(orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+                    status=status, mimetype='application/json')
+
 def cleanup_old_files(folder, max_age_hours=24):
     """Remove files older than max_age_hours"""
-    import time
-    current_time = time.time()
-    for file_path in Path(folder).glob('*'):
-        if file_path.is_file():
-            file_age = current_time - file_path.stat().st_mtime
-            if file_age > max_age_hours * 3600:
-                file_path.unlink()
+    cutoff = time.time() - max_age_hours * 3600
+    # scandir entries carry the file type (and on Windows the stat) already
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+
+def schedule_cleanup(interval_s=CLEANUP_INTERVAL_S):
+    """Clean up uploads/results now, then again every interval_s on a daemon timer"""
+    try:
+        cleanup_old_files(UPLOAD_FOLDER)
+        cleanup_old_files(RESULTS_FOLDER)
+    except Exception as e:
+        print(f"❌ Cleanup failed: {e}")
+
+    timer = threading.Timer(interval_s, schedule_cleanup, args=(interval_s,))
+    timer.daemon = True
+    timer.start()
+
+schedule_cleanup()
 
 @app.route('/')
 def index():
@@ -77,6 +139,68 @@ def model_info():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def validate_upload():
+    """Return (file, None) for a valid upload, or (None, error_response)"""
+    if 'file' not in request.files:
+        return None, (jsonify({'error': 'No file provided'}), 400)
+
+    file = request.files['file']
+
+    if file.filename == '':
+        return None, (jsonify({'error': 'No file selected'}), 400)
+
+    if not allowed_file(file.filename):
+        return None, (jsonify({'error': f'Invalid file type. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400)
+
+    return file, None
+
+def analyze_image(image_source, file_id):
+    """
+    Run the (batched) two-stage pipeline on one image and save its Grad-CAM
+    overlays. image_source is a path or the raw encoded image bytes.
+    Returns the JSON payload for the frontend.
+    """
+    (brain_tensor, bone_tensor), original_image = preprocess_image(image_source)
+    results = batcher.submit(brain_tensor, bone_tensor,
+                             original_image.shape[:2]).result(timeout=INFERENCE_TIMEOUT_S)
+
+    # Format results
+    formatted_results = format_results_for_display(results)
+
+    # Generate Grad-CAM if hemorrhage detected
+    gradcam_images = []
+    if results['stage2'] is not None and results['stage2']['detected_subtypes']:
+        print("Generating Grad-CAM visualizations...")
+
+        gradcam_results = render_gradcam_for_subtypes(
+            original_image,
+            results['stage2']['detected_subtypes'],
+            results['cams']
+        )
+
+        # Save Grad-CAM images
+        for subtype_name, gradcam_data in gradcam_results.items():
+            # Save heatmap overlay
+            heatmap_filename = f"{file_id}_{subtype_name.replace(' ', '_')}_gradcam.png"
+            heatmap_path = RESULTS_FOLDER / heatmap_filename
+
+            # Encode + write in the background; the URL is returned right away
+            IO_POOL.submit(save_png, heatmap_path, gradcam_data['heatmap'])
+
+            gradcam_images.append({
+                'subtype': subtype_name,
+                'image_url': f'/static/results/{heatmap_filename}',
+                'probability': gradcam_data['probability'],
+                'boxes': gradcam_data['boxes']
+            })
+
+    return {
+        'success': True,
+        'results': formatted_results,
+        'gradcam': gradcam_images,
+        'timestamp': datetime.now().isoformat()
+    }
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """Handle file upload"""
@@ -85,17 +209,9 @@ def upload_file():
         if detector_model is None or classifier_model is None:
             return jsonify({'error': 'Models not loaded. Please restart the server.'}), 500
         
-        # Check if file is present
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': f'Invalid file type. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+        file, error = validate_upload()
+        if error:
+            return error
         
         # Generate unique filename
         file_ext = file.filename.rsplit('.', 1)[1].lower()
@@ -121,8 +237,11 @@ def upload_file():
 
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
-    """Run inference on uploaded image"""
+    """Run inference on a previously uploaded image"""
     try:
+        if batcher is None:
+            return jsonify({'error': 'Models not loaded. Please restart the server.'}), 500
+
         data = request.get_json()
         filename = data.get('filename')
         
@@ -134,59 +253,39 @@ def analyze():
         if not filepath.exists():
             return jsonify({'error': 'File not found'}), 404
         
-        # Run inference pipeline
         print(f"Running inference on {filename}...")
-        results = run_full_pipeline(detector_model, classifier_model, str(filepath), device)
-        
-        # Format results
-        formatted_results = format_results_for_display(results)
-        
-        # Generate Grad-CAM if hemorrhage detected
-        gradcam_images = []
-        if results['stage2'] is not None and results['stage2']['detected_subtypes']:
-            print("Generating Grad-CAM visualizations...")
-            
-            gradcam_results = generate_gradcam_for_subtypes(
-                classifier_model,
-                results['image_tensor'],
-                results['original_image'],
-                results['stage2']['detected_subtypes'],
-                device
-            )
-            
-            # Save Grad-CAM images
-            file_id = filename.rsplit('.', 1)[0]
-            for subtype_name, gradcam_data in gradcam_results.items():
-                # Save heatmap overlay
-                heatmap_filename = f"{file_id}_{subtype_name.replace(' ', '_')}_gradcam.png"
-                heatmap_path = RESULTS_FOLDER / heatmap_filename
-                
-                # Convert to PIL and save
-                heatmap_image = Image.fromarray(gradcam_data['heatmap'].astype('uint8'))
-                heatmap_image.save(heatmap_path)
-                
-                gradcam_images.append({
-                    'subtype': subtype_name,
-                    'image_url': f'/static/results/{heatmap_filename}',
-                    'probability': gradcam_data['probability'],
-                    'boxes': gradcam_data['boxes']
-                })
-        
-        # Cleanup old files
-        cleanup_old_files(UPLOAD_FOLDER)
-        cleanup_old_files(RESULTS_FOLDER)
-        
-        return jsonify({
-            'success': True,
-            'results': formatted_results,
-            'gradcam': gradcam_images,
-            'timestamp': datetime.now().isoformat()
-        })
+        return json_response(analyze_image(str(filepath), filename.rsplit('.', 1)[0]))
     
     except Exception as e:
         print(f"Analysis error: {traceback.format_exc()}")
         return jsonify({'error': f'Analysis failed: {str(e)}'}), 500
 
+@app.route('/api/detect', methods=['POST'])
+def detect():
+    """Upload + analyze in one request; the image stays in memory"""
+    try:
+        if batcher is None:
+            return jsonify({'error': 'Models not loaded. Please restart the server.'}), 500
+
+        file, error = validate_upload()
+        if error:
+            return error
+
+        image_bytes = file.read()
+        file_id = str(uuid.uuid4())
+
+        # Only write the upload to disk when the client asks for it
+        if request.form.get('save', '').lower() in ('1', 'true', 'yes'):
+            file_ext = file.filename.rsplit('.', 1)[1].lower()
+            (UPLOAD_FOLDER / f"{file_id}.{file_ext}").write_bytes(image_bytes)
+
+        print(f"Running inference on {file.filename}...")
+        return json_response(analyze_image(image_bytes, file_id))
+
+    except Exception as e:
+        print(f"Analysis error: {traceback.format_exc()}")
+        return jsonify({'error': f'Analysis failed: {str(e)}'}), 500
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files"""
@@ -211,5 +310,5 @@ if __name__ == '__main__':
     print(f"Results folder: {RESULTS_FOLDER}")
     print("="*60 + "\n")
     
-    # Run Flask app
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Run Flask app (waitress instead of the single-request debug server)
+    serve(app, host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS)
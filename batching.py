@@ -0,0 +1,139 @@
+"""
+Dynamic Batching for the Two-Stage Inference Pipeline
+Coalesces concurrent requests into one batched forward pass on a single worker thread
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from inference import run_batch_pipeline, warmup_pipeline
+
+# Queue marker for warm-up jobs (see DynamicBatcher.warmup)
+_WARMUP = object()
+
+
+class DynamicBatcher:
+    """
+    Collects up to max_batch images (whatever arrives within max_wait_ms of
+    the first one) and runs them through run_batch_pipeline together.
+
+    Every model call, Grad-CAM backward passes included, happens on the
+    single worker thread, so the models and their hooks are never used
+    from two request threads at once.
+    """
+    def __init__(self, detector_model, classifier_model, device,
+                 max_batch=16, max_wait_ms=10, gradcam=True):
+        self.detector_model = detector_model
+        self.classifier_model = classifier_model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.gradcam = gradcam
+
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="inference-batcher",
+                                        daemon=True)
+        self._worker.start()
+
+    def submit(self, brain_tensor, bone_tensor, image_size=None):
+        """
+        Queue one image ([1, 3, H, W] tensors); image_size is its original
+        (h, w), used to return full-resolution Grad-CAMs.
+
+        Returns:
+            Future resolving to its run_batch_pipeline results dict
+        """
+        future = Future()
+        self._queue.put((brain_tensor, bone_tensor, image_size, future))
+        return future
+
+    def warmup(self, batch_sizes=(1,), timeout=None):
+        """
+        Run warmup_pipeline for each batch size on the worker thread and wait
+        for it. Compiled models record their CUDA graphs per thread, so
+        warming them up anywhere else doesn't spare the first requests.
+        """
+        future = Future()
+        self._queue.put((_WARMUP, batch_sizes, None, future))
+        return future.result(timeout=timeout)
+
+    def _warmup(self, batch_sizes, future):
+        try:
+            for batch_size in batch_sizes:
+                warmup_pipeline(self.detector_model, self.classifier_model, self.device,
+                                batch_size=batch_size)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            for brain, batch_sizes, _, future in batch:
+                if brain is _WARMUP:
+                    self._warmup(batch_sizes, future)
+            batch = [item for item in batch if item[0] is not _WARMUP]
+            if not batch:
+                continue
+
+            futures = [future for _, _, _, future in batch]
+
+            try:
+                brain_tensor = _stack([brain for brain, _, _, _ in batch])
+                # Deployment feeds the same tensor to both branches; keep it shared
+                if all(brain is bone for brain, bone, _, _ in batch):
+                    bone_tensor = brain_tensor
+                else:
+                    bone_tensor = _stack([bone for _, bone, _, _ in batch])
+
+                image_sizes = [image_size for _, _, image_size, _ in batch]
+                if any(image_size is None for image_size in image_sizes):
+                    image_sizes = None
+
+                results = run_batch_pipeline(
+                    self.detector_model, self.classifier_model,
+                    brain_tensor, bone_tensor, self.device,
+                    gradcam=self.gradcam, image_sizes=image_sizes
+                )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+def _stack(tensors):
+    """
+    Concatenate [1, 3, H, W] tensors along the batch dim, keeping the
+    result in pinned memory when the inputs are pinned.
+    """
+    if len(tensors) == 1:
+        return tensors[0]
+
+    first = tensors[0]
+    out = torch.empty((len(tensors),) + tuple(first.shape[1:]), dtype=first.dtype,
+                      pin_memory=first.is_pinned())
+    return torch.cat(tensors, out=out)
@@ -19,95 +19,189 @@ SUBTYPE_COLORS = {
     "Skull Fracture":   (0, 255, 255)       # Cyan
 }
 
+# JET colormap as an RGB lookup table, so no BGR→RGB pass is needed
+_JET_RGB_LUT = np.ascontiguousarray(
+    cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1),
+                      cv2.COLORMAP_JET)[:, :, ::-1]
+)
+
 
 class DualBranchGradCAM:
     def __init__(self, model, target_layer):
-        self.model = model
+        # Hooks and backward need the eager module, not a torch.compile wrapper
+        self.model = getattr(model, "_orig_mod", model)
         self.target_layer = target_layer
         self.gradients = None
         self.activations = None
+        self.logits = None
 
         # Hooks
-        target_layer.register_forward_hook(self._save_activation)
-        target_layer.register_backward_hook(self._save_gradient)
+        self._handles = [
+            target_layer.register_forward_hook(self._save_activation),
+            target_layer.register_full_backward_hook(self._save_gradient),
+        ]
+
+    def remove_hooks(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+        # Release the forward graph
+        self.logits = None
+        self.activations = None
 
     def _save_activation(self, module, inp, out):
-        self.activations = out.detach()
+        # Kept attached to the graph so gradients can stop at this layer
+        self.activations = out
 
     def _save_gradient(self, module, grad_in, grad_out):
         self.gradients = grad_out[0].detach()
 
-    def generate_cam(self, brain_tensor, bone_tensor, class_idx, device):
+    def forward(self, brain_tensor, bone_tensor, device):
+        """
+        Grad-enabled forward pass. The graph is kept on self.logits so
+        every following generate_cam call only needs a backward pass.
+        """
         self.model.eval()
 
-        brain_tensor = brain_tensor.to(device)
-        bone_tensor = bone_tensor.to(device)
+        # Grad-CAM needs autograd, so this pass runs outside inference_mode
+        shared = bone_tensor is brain_tensor
+        brain_tensor = brain_tensor.to(device, memory_format=torch.channels_last)
+        bone_tensor = brain_tensor if shared else bone_tensor.to(device, memory_format=torch.channels_last)
 
-        # Forward pass
-        logits = self.model(brain_tensor, bone_tensor)
-        score = logits[0, class_idx]
+        with torch.enable_grad():
+            self.logits = self.model(brain_tensor, bone_tensor)
+        return self.logits
+
+    def generate_cam(self, brain_tensor, bone_tensor, class_idx, device, size=None,
+                     retain_graph=False):
+        """
+        Single-class CAM. When looping over several classes on one forward
+        pass, pass retain_graph=True for all but the last one; the graph is
+        freed after the last backward.
+        """
+        # Forward pass (reused when already run, e.g. by Stage 2)
+        if self.logits is None:
+            self.forward(brain_tensor, bone_tensor, device)
+        score = self.logits[0, class_idx]
 
         # Backward
         self.model.zero_grad()
-        score.backward(retain_graph=True)
+        score.backward(retain_graph=retain_graph)
+
+        cam = self._compute_cam(self.gradients[0], self.activations[0], size)
+        if not retain_graph:
+            # Graph is gone; the next call needs a fresh forward pass
+            self.logits = None
+        return cam
+
+    def generate_batch_cams(self, targets, sizes=None):
+        """
+        CAMs for several classes/images after one forward pass.
+
+        targets: [(row, class_idx)]. Every class gets a one-hot gradient
+        over the logits and all of them go through a single batched
+        backward (is_grads_batched) that stops at the target layer,
+        so no parameter gradients are computed. Images in a batch are
+        independent in eval mode, so one one-hot covers every row.
 
-        grads = self.gradients[0]      # [C, H, W]
-        acts = self.activations[0]     # [C, H, W]
+        sizes: optional (h, w) per row to upsample each CAM to (see _compute_cam).
+
+        Returns:
+            {(row, class_idx): cam}
+        """
+        class_idxs = sorted({class_idx for _, class_idx in targets})
+
+        grad_outputs = torch.zeros((len(class_idxs),) + tuple(self.logits.shape),
+                                   dtype=self.logits.dtype, device=self.logits.device)
+        for k, class_idx in enumerate(class_idxs):
+            grad_outputs[k, :, class_idx] = 1
+
+        grads, = torch.autograd.grad(self.logits, self.activations,
+                                     grad_outputs=grad_outputs,
+                                     is_grads_batched=True)  # [K, B, C, H, W]
+
+        cams = {}
+        for row, class_idx in targets:
+            k = class_idxs.index(class_idx)
+            size = sizes[row] if sizes is not None else None
+            cams[(row, class_idx)] = self._compute_cam(grads[k, row],
+                                                       self.activations[row], size)
+        return cams
+
+    @staticmethod
+    @torch.no_grad()
+    def _compute_cam(grads, acts, size=None):
+        """
+        grads, acts: [C, H, W]
+
+        Returns a uint8 CAM (0-255), upsampled on the device to `size`
+        (h, w) when given, so only the final map is copied to the host.
+        """
+        # FP32 math even when the backbone runs in FP16/BF16
+        grads, acts = grads.float(), acts.float()
 
         weights = grads.mean(dim=(1, 2))  # GAP over H,W → [C]
 
-        cam = torch.zeros(acts.shape[1:], device=acts.device)
-        for i, w in enumerate(weights):
-            cam += w * acts[i]
+        # Weighted sum over channels + ReLU in one kernel
+        cam = torch.einsum("c,chw->hw", weights, acts).relu_()
 
-        cam = F.relu(cam)
+        cam.sub_(cam.min())
+        cam.div_(cam.max().clamp(min=1e-8))
 
-        cam -= cam.min()
-        if cam.max() > 0:
-            cam /= cam.max()
+        if size is not None:
+            cam = F.interpolate(cam[None, None], size=tuple(size), mode="bilinear",
+                                align_corners=False)[0, 0]
 
-        return cam.cpu().numpy()
+        return cam.mul_(255).to(torch.uint8).cpu().numpy()
 
     @staticmethod
-    def generate_overlay(original_image, cam, alpha=0.45):
+    def generate_overlay(original_image, cam, alpha=0.45, heatmap=None, out=None):
         """
         Create visualization: original + heatmap overlay
+
+        cam: uint8 CAM, ideally already at the original resolution
+             (float CAMs in [0, 1] are converted).
+        heatmap, out: optional preallocated HxWx3 uint8 buffers that the
+             colormap and the overlay are written into.
         """
         if isinstance(original_image, Image.Image):
             original = np.array(original_image)
         else:
             original = original_image
 
+        if cam.dtype != np.uint8:
+            cam = np.uint8(255 * cam)
+
         h, w = original.shape[:2]
-        cam_resized = cv2.resize(cam, (w, h))
+        cam_resized = cam if cam.shape[:2] == (h, w) else cv2.resize(cam, (w, h))
 
-        heatmap = np.uint8(255 * cam_resized)
-        heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-        heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
+        heatmap = cv2.applyColorMap(cam_resized, _JET_RGB_LUT, dst=heatmap)
 
-        overlay = cv2.addWeighted(original, 1 - alpha, heatmap, alpha, 0)
+        overlay = cv2.addWeighted(original, 1 - alpha, heatmap, alpha, 0, dst=out)
         return overlay, cam_resized
 
     @staticmethod
     def extract_bounding_boxes(cam_resized, threshold=0.55, min_area=150):
         """
-        Extract bounding boxes directly on resized CAM.
+        Extract bounding boxes directly on resized (uint8) CAM.
         Returns box coordinates in ORIGINAL IMAGE resolution.
         """
-        mask = (cam_resized > threshold).astype("uint8") * 255
+        _, mask = cv2.threshold(cam_resized, int(255 * threshold), 255, cv2.THRESH_BINARY)
+
+        stats = _component_stats(mask)
+        keep = stats[:, cv2.CC_STAT_AREA] >= min_area
 
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL,
-                                       cv2.CHAIN_APPROX_SIMPLE)
+        return [tuple(box) for box in stats[keep, :4].tolist()]
 
-        boxes = []
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area < min_area:
-                continue
-            x, y, w, h = cv2.boundingRect(cnt)
-            boxes.append((x, y, w, h))
 
-        return boxes
+def _component_stats(mask):
+    """
+    Per-component [x, y, w, h, area] of the 8-connected foreground regions
+    of a binary mask, from a single connectedComponentsWithStats pass.
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    return stats[1:]  # row 0 is the background
 
 
 def _get_brain_target_layer(model):
@@ -120,6 +214,15 @@ def _get_brain_target_layer(model):
     raise RuntimeError("Model brain branch not found")
 
 
+def build_gradcam(model):
+    """
+    Attach Grad-CAM hooks to the brain branch of a dual-branch model
+    """
+    # Compiled / CUDA-graph / TensorRT wrappers keep the eager model here
+    model = getattr(model, "_orig_mod", model)
+    return DualBranchGradCAM(model, _get_brain_target_layer(model))
+
+
 def generate_gradcam_for_subtypes(model, input_tensor, original_image,
                                   detected_subtypes, device,
                                   cam_threshold=0.25):
@@ -130,51 +233,79 @@ def generate_gradcam_for_subtypes(model, input_tensor, original_image,
                 "heatmap": overlay_with_boxes,
                 "boxes": [(x,y,w,h)],
                 "probability": float,
-                "cam": heatmap_matrix
+                "cam": uint8_heatmap_matrix
             }
         }
     """
 
-    results = {}
     if not detected_subtypes:
-        return results
+        return {}
 
     brain_tensor, bone_tensor = input_tensor
 
     # Target = last conv layer of brain branch
-    target_layer = model.brain_net.features[-1]
-    gradcam = DualBranchGradCAM(model, target_layer)
+    gradcam = build_gradcam(model)
+    gradcam.forward(brain_tensor, bone_tensor, device)
+
+    batch_cams = gradcam.generate_batch_cams(
+        [(0, class_idx) for _, _, class_idx in detected_subtypes],
+        sizes=[np.asarray(original_image).shape[:2]]
+    )
+    gradcam.remove_hooks()
+
+    cams = {class_idx: cam for (_, class_idx), cam in batch_cams.items()}
 
+    return render_gradcam_for_subtypes(original_image, detected_subtypes,
+                                       cams, cam_threshold)
+
+
+def render_gradcam_for_subtypes(original_image, detected_subtypes, cams,
+                                cam_threshold=0.25):
+    """
+    Overlay + bounding boxes for CAMs that are already computed
+    (e.g. by inference.run_batch_pipeline).
+
+    cams: {class_idx: cam}
+
+    Returns the same structure as generate_gradcam_for_subtypes.
+    """
+
+    original = np.asarray(original_image)
+    h, w = original.shape[:2]
+
+    # Scratch buffers shared by every subtype; only the overlay that is
+    # returned gets its own allocation
+    heatmap_buf = np.empty((h, w, 3), dtype=np.uint8)
+    mask_buf = np.empty((h, w), dtype=np.uint8)
+
+    results = {}
     for subtype_name, prob, class_idx in detected_subtypes:
 
         # ---------- CAM ----------
-        cam = gradcam.generate_cam(brain_tensor, bone_tensor,
-                                   class_idx, device)
+        cam = cams[class_idx]
 
         # ---------- Heatmap Overlay ----------
-        overlay, cam_resized = DualBranchGradCAM.generate_overlay(original_image, cam)
+        overlay, cam_resized = DualBranchGradCAM.generate_overlay(
+            original, cam, heatmap=heatmap_buf, out=np.empty_like(heatmap_buf)
+        )
 
         # ---------- Bounding Boxes ----------
-        mask = (cam_resized > cam_threshold).astype("uint8") * 255
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        boxes = []
-        for cnt in contours:
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w*h < 60:    # ignore tiny noise boxes
-                continue
-            boxes.append((x, y, w, h))
+        _, mask = cv2.threshold(cam_resized, int(255 * cam_threshold), 255,
+                                cv2.THRESH_BINARY, dst=mask_buf)
+        stats = _component_stats(mask)
+        keep = stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT] >= 60  # ignore tiny noise boxes
+        boxes = [tuple(box) for box in stats[keep, :4].tolist()]
 
         # ---------- Draw boxes directly ----------
         color = SUBTYPE_COLORS.get(subtype_name, (255, 255, 255))
 
-        overlay_boxes = overlay.copy()
-        for (x, y, w, h) in boxes:
-            cv2.rectangle(overlay_boxes, (x, y), (x+w, y+h), color, 3)
+        # The overlay is this subtype's own buffer, so draw on it in place
+        for (x, y, bw, bh) in boxes:
+            cv2.rectangle(overlay, (x, y), (x+bw, y+bh), color, 3)
 
         # ---------- Store outputs ----------
         results[subtype_name] = {
-            "heatmap": overlay_boxes,
+            "heatmap": overlay,
             "boxes": boxes,
             "probability": prob,
             "cam": cam_resized
@@ -3,11 +3,15 @@ Two-Stage Inference Pipeline for Brain Hemorrhage Detection
 Stage 1: Binary Detection | Stage 2: Subtype Classification
 """
 
+import contextlib
+
+import cv2
+import numpy as np
 import torch
 import torch.nn.functional as F
-from torchvision import transforms
 from PIL import Image
-import numpy as np
+
+from gradcam import build_gradcam
 
 # Hemorrhage subtypes (in order of model output)
 HEMORRHAGE_SUBTYPES = [
@@ -32,38 +36,59 @@ SUBTYPE_THRESHOLDS = {
 # Stage 1 threshold
 HEMORRHAGE_DETECTION_THRESHOLD = 0.5
 
+# Model input size and ImageNet normalisation (same as training)
+IMAGE_SIZE = 224
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
 
-def get_image_transforms():
-    """
-    Preprocessing (same as training: resize + normalize with ImageNet stats)
-    """
-    return transforms.Compose(
-        [
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406],
-                std=[0.229, 0.224, 0.225],
-            ),
-        ]
-    )
+# (x / 255 - mean) / std folded into a single x * scale + offset
+_NORM_SCALE = (1.0 / (255.0 * np.array(IMAGENET_STD))).astype(np.float32)
+_NORM_OFFSET = (-np.array(IMAGENET_MEAN) / np.array(IMAGENET_STD)).astype(np.float32)
 
+# SUBTYPE_THRESHOLDS as tensors in model output order, one per device
+_THRESHOLD_TENSORS = {}
 
-def preprocess_image(image_path):
+
+def preprocess_image(image_source):
     """
     Load and preprocess CT image.
 
+    image_source: file path, or the raw encoded image (bytes / binary
+    file-like object, e.g. an upload stream) to decode in memory.
+
     For deployment GUI: we only have one image, so we feed the
     same tensor into both brain and bone branches.
 
+    Same preprocessing as training (torchvision Resize + ToTensor +
+    Normalize on a PIL image): OpenCV decode, PIL bilinear resize (what
+    Resize does for PIL images, antialiased), then one fused normalize +
+    HWC→CHW pass in numpy.
+
     Returns:
-        ((brain_tensor, bone_tensor), original_pil_image)
+        ((brain_tensor, bone_tensor), original_rgb_uint8_array)
     """
-    image = Image.open(image_path).convert("RGB")
-    original_image = image.copy()
+    if hasattr(image_source, "read"):
+        image_source = image_source.read()
+
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        encoded = np.frombuffer(image_source, dtype=np.uint8)
+    else:
+        # np.fromfile + imdecode instead of imread so non-ASCII paths work on Windows
+        encoded = np.fromfile(image_source, dtype=np.uint8)
 
-    transform = get_image_transforms()
-    tensor = transform(image).unsqueeze(0)  # [1, 3, H, W]
+    image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+    original_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    resized = np.asarray(Image.fromarray(original_image).resize(
+        (IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR))
+    array = resized * _NORM_SCALE + _NORM_OFFSET  # float32 [H, W, 3]
+
+    tensor = torch.from_numpy(np.ascontiguousarray(array.transpose(2, 0, 1))).unsqueeze(0)  # [1, 3, H, W]
+    if torch.cuda.is_available():
+        # Pinned host memory for async H2D copies
+        tensor = tensor.pin_memory()
 
     # Use the same tensor for brain and bone branches in deployment
     brain_tensor = tensor
@@ -72,101 +97,254 @@ def preprocess_image(image_path):
     return (brain_tensor, bone_tensor), original_image
 
 
-def stage1_inference(detector_model, brain_tensor, bone_tensor, device):
+def autocast_context(device, model=None, cache_enabled=True):
     """
-    Stage 1: Binary Hemorrhage Detection
+    Mixed precision for the inference-only forward passes.
 
-    detector_model outputs a single logit; we apply sigmoid here.
+    Models with an autocast_dtype (load_models' classifier, whose weights
+    stay FP32 for Grad-CAM) are autocast to it. Models whose backbones are
+    already cast to their precision (cast_backbones sets input_dtype) run
+    as they are. Other models get FP16 autocast on CUDA; CPU stays in FP32
+    since bf16 is only faster on CPUs with native support.
     """
-    with torch.no_grad():
-        brain_tensor = brain_tensor.to(device)
-        bone_tensor = bone_tensor.to(device)
+    while hasattr(model, "_orig_mod"):
+        model = model._orig_mod
 
-        logits = detector_model(brain_tensor, bone_tensor)  # [B] or scalar
-        # Ensure scalar
-        if logits.ndim > 0:
-            logit = logits[0]
-        else:
-            logit = logits
+    device_type = torch.device(device).type
+    dtype = getattr(model, "autocast_dtype", None)
+    if dtype is None:
+        if hasattr(model, "input_dtype") or device_type != "cuda":
+            return contextlib.nullcontext()
+        dtype = torch.float16
+    return torch.autocast(device_type=device_type, dtype=dtype, cache_enabled=cache_enabled)
 
-        probability = torch.sigmoid(logit).item()
 
-        has_hemorrhage = probability >= HEMORRHAGE_DETECTION_THRESHOLD
+def inputs_to_device(brain_tensor, bone_tensor, device):
+    """
+    Move the branch inputs to `device` (channels_last). Deployment feeds one
+    tensor to both branches, in which case it is copied only once.
+    No-op for tensors already on `device`.
+    """
+    shared = bone_tensor is brain_tensor
+    brain_tensor = brain_tensor.to(device, memory_format=torch.channels_last, non_blocking=True)
+    if shared:
+        return brain_tensor, brain_tensor
 
-        # Confidence bands (just UI logic)
-        if probability < 0.3 or probability > 0.7:
-            confidence = "High"
-        elif probability < 0.4 or probability > 0.6:
-            confidence = "Medium"
-        else:
-            confidence = "Low"
+    bone_tensor = bone_tensor.to(device, memory_format=torch.channels_last, non_blocking=True)
+    return brain_tensor, bone_tensor
 
-        return {
-            "has_hemorrhage": has_hemorrhage,
-            "probability": round(probability, 4),
-            "confidence": confidence,
-            "threshold": HEMORRHAGE_DETECTION_THRESHOLD,
-        }
 
+def stage1_batch(detector_model, brain_tensor, bone_tensor, device):
+    """
+    Stage 1: Binary Hemorrhage Detection on a batch [B, 3, H, W].
 
-def stage2_inference(classifier_model, brain_tensor, bone_tensor, device):
+    detector_model outputs a single logit per image; we apply sigmoid here.
+    Returns one result dict per image.
     """
-    Stage 2: Multi-label Subtype Classification.
+    with torch.inference_mode():
+        brain_tensor, bone_tensor = inputs_to_device(brain_tensor, bone_tensor, device)
 
-    classifier_model outputs logits for all 6 subtypes; we apply sigmoid.
+        with autocast_context(device, detector_model):
+            logits = detector_model(brain_tensor, bone_tensor)  # [B] or scalar
+        probabilities = torch.sigmoid(logits.float()).reshape(-1).tolist()
+
+    return [_stage1_result(probability) for probability in probabilities]
+
+
+def stage1_inference(detector_model, brain_tensor, bone_tensor, device):
+    """
+    Stage 1 for a single image.
     """
-    with torch.no_grad():
-        brain_tensor = brain_tensor.to(device)
-        bone_tensor = bone_tensor.to(device)
+    return stage1_batch(detector_model, brain_tensor, bone_tensor, device)[0]
+
+
+def _stage1_result(probability):
+    has_hemorrhage = probability >= HEMORRHAGE_DETECTION_THRESHOLD
+
+    # Confidence bands (just UI logic)
+    if probability < 0.3 or probability > 0.7:
+        confidence = "High"
+    elif probability < 0.4 or probability > 0.6:
+        confidence = "Medium"
+    else:
+        confidence = "Low"
+
+    return {
+        "has_hemorrhage": has_hemorrhage,
+        "probability": round(probability, 4),
+        "confidence": confidence,
+        "threshold": HEMORRHAGE_DETECTION_THRESHOLD,
+    }
 
-        logits = classifier_model(brain_tensor, bone_tensor)  # [1, 6]
-        probabilities = torch.sigmoid(logits).squeeze().cpu().numpy()  # [6]
 
-        # Ensure np.array
-        probabilities = np.array(probabilities, dtype=float)
+def stage2_batch(classifier_model, brain_tensor, bone_tensor, device, logits=None):
+    """
+    Stage 2: Multi-label Subtype Classification on a batch [B, 3, H, W].
+
+    classifier_model outputs logits for all 6 subtypes; we apply sigmoid.
+    Pass precomputed `logits` to skip the forward pass.
+    Returns one result dict per image.
+    """
+    with torch.inference_mode():
+        if logits is None:
+            brain_tensor, bone_tensor = inputs_to_device(brain_tensor, bone_tensor, device)
 
-        all_probs = {
-            HEMORRHAGE_SUBTYPES[i]: round(float(probabilities[i]), 4)
-            for i in range(len(HEMORRHAGE_SUBTYPES))
-        }
+            with autocast_context(device, classifier_model):
+                logits = classifier_model(brain_tensor, bone_tensor)  # [B, 6]
+        probabilities = torch.sigmoid(logits.float()).reshape(-1, len(HEMORRHAGE_SUBTYPES))
 
-        detected = []
-        for i, subtype in enumerate(HEMORRHAGE_SUBTYPES):
-            prob = float(probabilities[i])
-            threshold = SUBTYPE_THRESHOLDS[subtype]
+        # Threshold on device, then a single device→host copy of probs + mask
+        detected = probabilities >= _subtype_thresholds(probabilities.device)
+        probabilities, detected = torch.stack((probabilities, detected.float())).tolist()
 
-            if prob >= threshold:
-                detected.append((subtype, round(prob, 4), i))
+    return [_stage2_result(probs, mask) for probs, mask in zip(probabilities, detected)]
 
-        detected.sort(key=lambda x: x[1], reverse=True)
 
-        return {
-            "detected_subtypes": detected,
-            "all_probabilities": all_probs,
-            "thresholds": SUBTYPE_THRESHOLDS,
-        }
+def _subtype_thresholds(device):
+    if device not in _THRESHOLD_TENSORS:
+        _THRESHOLD_TENSORS[device] = torch.tensor(
+            [SUBTYPE_THRESHOLDS[subtype] for subtype in HEMORRHAGE_SUBTYPES], device=device
+        )
+    return _THRESHOLD_TENSORS[device]
 
 
-def run_full_pipeline(detector_model, classifier_model, image_path, device):
+def stage2_inference(classifier_model, brain_tensor, bone_tensor, device, logits=None):
     """
-    Run the complete two-stage pipeline on one image.
+    Stage 2 for a single image.
     """
-    (brain_tensor, bone_tensor), original_image = preprocess_image(image_path)
+    return stage2_batch(classifier_model, brain_tensor, bone_tensor, device, logits=logits)[0]
 
-    # Stage 1: binary detection
-    stage1_results = stage1_inference(detector_model, brain_tensor, bone_tensor, device)
 
-    results = {
-        "stage1": stage1_results,
-        "stage2": None,
-        "image_tensor": (brain_tensor, bone_tensor),  # for Grad-CAM
-        "original_image": original_image,
+def _stage2_result(probabilities, detected_mask):
+    all_probs = {
+        subtype: round(prob, 4)
+        for subtype, prob in zip(HEMORRHAGE_SUBTYPES, probabilities)
+    }
+
+    detected = [
+        (HEMORRHAGE_SUBTYPES[i], round(probabilities[i], 4), i)
+        for i, hit in enumerate(detected_mask)
+        if hit
+    ]
+    detected.sort(key=lambda x: x[1], reverse=True)
+
+    return {
+        "detected_subtypes": detected,
+        "all_probabilities": all_probs,
+        "thresholds": SUBTYPE_THRESHOLDS,
     }
 
-    # Only run subtype classifier if hemorrhage detected
-    if stage1_results["has_hemorrhage"]:
-        stage2_results = stage2_inference(classifier_model, brain_tensor, bone_tensor, device)
-        results["stage2"] = stage2_results
+
+def run_batch_pipeline(detector_model, classifier_model, brain_tensor, bone_tensor,
+                       device, gradcam=False, image_sizes=None):
+    """
+    Run the two-stage pipeline on a batch [B, 3, H, W]; Stage 2 only runs
+    on the images Stage 1 flags.
+
+    With gradcam=True the Stage 2 forward pass is run with gradients through
+    a DualBranchGradCAM and the CAM of every detected subtype is computed
+    here (under "cams", keyed by class index), since the graph only lives
+    for the duration of this call. image_sizes gives the original (h, w) of
+    each image so the CAMs come back at full resolution.
+    """
+    # One H2D copy shared by Stage 1, Stage 2 and Grad-CAM
+    brain_tensor, bone_tensor = inputs_to_device(brain_tensor, bone_tensor, device)
+
+    results = [
+        {"stage1": stage1_results, "stage2": None}
+        for stage1_results in stage1_batch(detector_model, brain_tensor, bone_tensor, device)
+    ]
+
+    # Only run subtype classifier on images with a detected hemorrhage
+    positive = [i for i, r in enumerate(results) if r["stage1"]["has_hemorrhage"]]
+    if not positive:
+        return results
+
+    if len(positive) < len(results):
+        brain_positive = brain_tensor[positive]
+        bone_positive = brain_positive if bone_tensor is brain_tensor else bone_tensor[positive]
+    else:
+        brain_positive, bone_positive = brain_tensor, bone_tensor
+
+    logits = None
+    cam = None
+    if gradcam:
+        cam = build_gradcam(classifier_model)
+        logits = cam.forward(brain_positive, bone_positive, device)
+
+    stage2_results = stage2_batch(
+        classifier_model, brain_positive, bone_positive, device, logits=logits
+    )
+    for i, stage2 in zip(positive, stage2_results):
+        results[i]["stage2"] = stage2
+
+    if cam is not None:
+        targets = [
+            (row, class_idx)
+            for row, stage2 in enumerate(stage2_results)
+            for _, _, class_idx in stage2["detected_subtypes"]
+        ]
+        sizes = [image_sizes[i] for i in positive] if image_sizes is not None else None
+        cams = cam.generate_batch_cams(targets, sizes) if targets else {}
+        cam.remove_hooks()
+
+        for row, i in enumerate(positive):
+            results[i]["cams"] = {
+                class_idx: cams[(row, class_idx)]
+                for _, _, class_idx in stage2_results[row]["detected_subtypes"]
+            }
+
+    return results
+
+
+def warmup_pipeline(detector_model, classifier_model, device, passes=2, batch_size=1):
+    """
+    Throwaway passes on a zero batch, covering both stages (the no-grad
+    Stage 2 forward as well as the Grad-CAM forward + backward), so CUDA
+    init, cuDNN autotuning (which needs a second pass with
+    cudnn.benchmark) and the CUDA graph recording of compiled models happen
+    at startup instead of on the first request.
+
+    Compiled models record their CUDA graphs per thread, so run it on the
+    thread that serves the requests (see DynamicBatcher.warmup).
+    """
+    dummy = torch.zeros(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+    if device.type == "cuda":
+        dummy = dummy.pin_memory()
+
+    for _ in range(passes):
+        brain_tensor, bone_tensor = inputs_to_device(dummy, dummy, device)
+        stage1_batch(detector_model, brain_tensor, bone_tensor, device)
+
+        # Stage 2 runs regardless of the Stage 1 result here
+        stage2_batch(classifier_model, brain_tensor, bone_tensor, device)
+        cam = build_gradcam(classifier_model)
+        try:
+            logits = cam.forward(brain_tensor, bone_tensor, device)
+            stage2_batch(classifier_model, brain_tensor, bone_tensor, device, logits=logits)
+            cam.generate_batch_cams([(0, 0)], sizes=[(IMAGE_SIZE, IMAGE_SIZE)])
+        finally:
+            cam.remove_hooks()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run_full_pipeline(detector_model, classifier_model, image_path, device, gradcam=False):
+    """
+    Run the complete two-stage pipeline on one image.
+
+    With gradcam=True the subtype CAMs are returned under "cams"
+    (see run_batch_pipeline).
+    """
+    (brain_tensor, bone_tensor), original_image = preprocess_image(image_path)
+
+    results = run_batch_pipeline(
+        detector_model, classifier_model, brain_tensor, bone_tensor, device,
+        gradcam=gradcam, image_sizes=[original_image.shape[:2]]
+    )[0]
+    results["image_tensor"] = (brain_tensor, bone_tensor)  # for Grad-CAM
+    results["original_image"] = original_image
 
     return results
 
@@ -174,12 +352,13 @@ def run_full_pipeline(detector_model, classifier_model, image_path, device):
 def format_results_for_display(results):
     """
     Format inference results for API / frontend.
+    Probabilities stay raw floats (0-1); the frontend formats percentages.
     """
     stage1 = results["stage1"]
 
     formatted = {
         "hemorrhage_detected": stage1["has_hemorrhage"],
-        "detection_probability": f"{stage1['probability'] * 100:.2f}%",
+        "detection_probability": stage1["probability"],
         "detection_confidence": stage1["confidence"],
         "subtypes": [],
     }
@@ -192,8 +371,7 @@ def format_results_for_display(results):
                 formatted["subtypes"].append(
                     {
                         "name": subtype,
-                        "probability": f"{prob * 100:.2f}%",
-                        "raw_probability": prob,
+                        "probability": prob,
                         "class_index": idx,
                     }
                 )
@@ -3,107 +3,479 @@ Model Loading Utilities for AI Hemorrhage Detection System
 Handles loading of both Stage 1 (detector) and Stage 2 (classifier) models
 """
 
+import gc
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 from torchvision import models
 from pathlib import Path
 
+from trt_engine import load_trt_engines
+
 # Base paths
 BASE_DIR = Path(__file__).parent
 MODELS_DIR = BASE_DIR / "Saved Models"
 
+# load_models results, keyed by device/precision/HEMO_INT8, stored with the
+# checkpoint mtimes they were loaded from
+_MODEL_CACHE = {}
+
+# Batch sizes torch.compile'd models are specialised for (see StaticBatchModule)
+COMPILE_BATCH_SIZES = (1, 2, 4, 8, 16)
+
+# Per-device (H2D, compute) CUDA streams for pipeline_infer, created on first use
+_PIPELINE_STREAMS = {}
+
+# load_models precision → backbone weight dtype
+PRECISIONS = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+# EfficientNet-B0 feature width (input of its classifier Linear)
+EFFICIENTNET_B0_FEATURES = 1280
+
 
 # ----------------------------
 #  Dual-branch EfficientNet
 # ----------------------------
+def _feature_backbone(inference_only=False):
+    """
+    EfficientNet-B0 returning [B, 1280] pooled features. Built with a
+    1-output classifier rather than the 1000-class one that would be
+    thrown away; the classifier becomes its dropout alone (Identity for
+    inference_only). It has no parameters, so checkpoints load unchanged.
+    """
+    net = models.efficientnet_b0(weights=None, num_classes=1)
+    net.classifier = nn.Identity() if inference_only else nn.Dropout(0.2)
+    return net
+
+
+def _branch_features(model, brain_img, bone_img):
+    """
+    [B, F] brain and bone features. With model.shared_backbone both inputs
+    go through brain_net as one [2B, 3, H, W] batch (a single pass when
+    they are the same tensor), followed by the per-branch adapters.
+
+    Inputs are cast to model.input_dtype when set (see cast_backbones) and
+    to channels_last, matching the conv weights (see load_models); both are
+    no-ops for inputs that already match.
+    """
+    dtype = getattr(model, "input_dtype", torch.float32)
+    shared = bone_img is brain_img
+    brain_img = brain_img.to(dtype, memory_format=torch.channels_last)
+    bone_img = brain_img if shared else bone_img.to(dtype, memory_format=torch.channels_last)
+
+    if not model.shared_backbone:
+        return model.brain_net(brain_img), model.bone_net(bone_img)
+
+    if bone_img is brain_img:
+        brain_feat = bone_feat = model.brain_net(brain_img)
+    else:
+        feats = model.brain_net(torch.cat([brain_img, bone_img], dim=0))
+        brain_feat, bone_feat = feats.split(brain_img.shape[0])
+
+    # Residual adapters; zero-initialised ones are the identity
+    return (brain_feat + model.brain_adapter(brain_feat),
+            bone_feat + model.bone_adapter(bone_feat))
+
+
+def _fc_head(model, brain_feat, bone_feat):
+    """
+    Linear over [brain_feat | bone_feat] without building the concatenated
+    [B, 2F] tensor: bias + brain @ W_brain.T + bone @ W_bone.T, as two
+    chained addmm calls. Autocast is off here, so the head runs in the fc
+    weights' dtype (FP32) even when the backbones are autocast.
+    """
+    dtype = model.fc_brain.weight.dtype
+    with torch.autocast(device_type=brain_feat.device.type, enabled=False):
+        out = torch.addmm(model.fc_brain.bias, model.dropout(brain_feat).to(dtype),
+                          model.fc_brain.weight.t())
+        return torch.addmm(out, model.dropout(bone_feat).to(dtype), model.fc_bone.weight.t())
+
+
+def _split_fc_on_load(module, state_dict, prefix, *args):
+    """
+    load_state_dict pre-hook: checkpoints with one fc over the concatenated
+    features load into fc_brain (brain columns + bias) and fc_bone.
+    """
+    weight = state_dict.pop(prefix + "fc.weight", None)
+    if weight is None:
+        return
+
+    brain_dim = module.fc_brain.in_features
+    state_dict[prefix + "fc_brain.weight"] = weight[:, :brain_dim].contiguous()
+    state_dict[prefix + "fc_bone.weight"] = weight[:, brain_dim:].contiguous()
+    state_dict[prefix + "fc_brain.bias"] = state_dict.pop(prefix + "fc.bias")
+
+
+def _model_device(model):
+    """
+    Device of a model's parameters (of the eager model for wrapped ones)
+    """
+    while hasattr(model, "_orig_mod"):
+        model = model._orig_mod
+    return next(model.parameters()).device
+
+
+@torch.no_grad()
+def infer_pinned(model, brain_host, bone_host):
+    """
+    Logits for host inputs (CPU tensors or numpy arrays). On CUDA they are
+    staged through pinned buffers kept on the model (allocated on first use
+    and per new shape) and copied on a dedicated stream with non_blocking
+    H2D transfers; the compute stream waits on that copy only.
+
+    model may be a wrapped one (compiled, CUDA-graphed, TensorRT), which
+    then runs the forward; the wrappers expose this as infer() too.
+    """
+    device = _model_device(model)
+    shared = bone_host is brain_host
+    brain_host = torch.as_tensor(brain_host, dtype=torch.float32)
+    bone_host = brain_host if shared else torch.as_tensor(bone_host, dtype=torch.float32)
+
+    if device.type != "cuda":
+        return model(brain_host.to(device), bone_host.to(device))
+
+    if getattr(model, "_pinned_brain", None) is None or model._pinned_brain.shape != brain_host.shape:
+        model._pinned_brain = torch.empty(brain_host.shape, pin_memory=True)
+        model._pinned_bone = torch.empty(brain_host.shape, pin_memory=True)
+        model._copy_stream = torch.cuda.Stream(device)
+        model._copy_done = None
+
+    # The previous call's H2D copy must finish before the buffers are reused
+    if model._copy_done is not None:
+        model._copy_done.synchronize()
+
+    model._pinned_brain.copy_(brain_host)
+    if not shared:
+        model._pinned_bone.copy_(bone_host)
+
+    with torch.cuda.stream(model._copy_stream):
+        brain_img = model._pinned_brain.to(device, non_blocking=True)
+        bone_img = brain_img if shared else model._pinned_bone.to(device, non_blocking=True)
+        model._copy_done = torch.cuda.Event()
+        model._copy_done.record()
+
+    compute_stream = torch.cuda.current_stream(device)
+    compute_stream.wait_stream(model._copy_stream)
+    brain_img.record_stream(compute_stream)
+    bone_img.record_stream(compute_stream)
+
+    return model(brain_img, bone_img)
+
+
+@torch.no_grad()
+def pipeline_infer(detector, classifier, brain_host, bone_host, chunk_size=4):
+    """
+    Detector and classifier logits for a batch of host inputs, both models
+    running on the same device copy.
+
+    On CUDA the batch goes through in chunks of chunk_size: chunk k+1 is
+    copied from pinned memory on an H2D stream while the detector and
+    classifier compute chunk k on a compute stream, so the transfers hide
+    behind the compute. Elsewhere it is two plain forwards.
+
+    Returns:
+        detector_logits [B], classifier_logits [B, num_classes]
+    """
+    device = _model_device(detector)
+    shared = bone_host is brain_host
+    brain_host = torch.as_tensor(brain_host, dtype=torch.float32)
+    bone_host = brain_host if shared else torch.as_tensor(bone_host, dtype=torch.float32)
+
+    if device.type != "cuda":
+        brain_img = brain_host.to(device)
+        bone_img = brain_img if shared else bone_host.to(device)
+        return detector(brain_img, bone_img), classifier(brain_img, bone_img)
+
+    if device not in _PIPELINE_STREAMS:
+        _PIPELINE_STREAMS[device] = (torch.cuda.Stream(device), torch.cuda.Stream(device))
+    h2d_stream, compute_stream = _PIPELINE_STREAMS[device]
+
+    brain_pinned = brain_host if brain_host.is_pinned() else brain_host.pin_memory()
+    bone_pinned = brain_pinned if shared else (
+        bone_host if bone_host.is_pinned() else bone_host.pin_memory())
+
+    def copy_chunk(start):
+        with torch.cuda.stream(h2d_stream):
+            brain_img = brain_pinned[start:start + chunk_size].to(device, non_blocking=True)
+            bone_img = brain_img if shared else \
+                bone_pinned[start:start + chunk_size].to(device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        return brain_img, bone_img, ready
+
+    batch_size = brain_host.shape[0]
+    detector_out, classifier_out = [], []
+    pending = copy_chunk(0)
+
+    with torch.cuda.stream(compute_stream):
+        for start in range(0, batch_size, chunk_size):
+            brain_img, bone_img, ready = pending
+            if start + chunk_size < batch_size:
+                pending = copy_chunk(start + chunk_size)  # overlaps the forwards below
+
+            compute_stream.wait_event(ready)
+            brain_img.record_stream(compute_stream)
+            bone_img.record_stream(compute_stream)
+
+            # Cloned: compiled (CUDA-graph) models reuse their output memory
+            # on the next call, which would overwrite the earlier chunks
+            detector_out.append(detector(brain_img, bone_img).clone())
+            classifier_out.append(classifier(brain_img, bone_img).clone())
+
+        detector_logits = torch.cat(detector_out)
+        classifier_logits = torch.cat(classifier_out)
+
+    # Hand the results back to the caller's stream
+    caller_stream = torch.cuda.current_stream(device)
+    caller_stream.wait_stream(compute_stream)
+    detector_logits.record_stream(caller_stream)
+    classifier_logits.record_stream(caller_stream)
+
+    return detector_logits, classifier_logits
+
+
+def _share_backbone(model, feat_dim):
+    """
+    Turn a freshly built dual-branch model into its shared_backbone form:
+    brain_net serves both inputs and each branch gets a small adapter.
+    """
+    del model.bone_net
+    model.brain_adapter = nn.Sequential(nn.Linear(feat_dim, feat_dim), nn.GELU())
+    model.bone_adapter = nn.Sequential(nn.Linear(feat_dim, feat_dim), nn.GELU())
+
+
+def migrate_checkpoint(state_dict):
+    """
+    Convert a two-branch state_dict for a shared_backbone model.
+
+    brain_net.* and bone_net.* are averaged into the shared brain_net and
+    the adapters are zero-initialised (the identity), giving a starting
+    point for fine-tuning; the averaged model is not equivalent to the
+    two-branch one until retrained. It is deliberately an explicit step:
+    loading a two-branch checkpoint straight into a shared_backbone model
+    fails on the bone_net.* keys.
+    """
+    migrated = {}
+    for key, value in state_dict.items():
+        if key.startswith("bone_net."):
+            continue
+
+        if key.startswith("brain_net.") and value.is_floating_point():
+            bone_value = state_dict.get("bone_net." + key[len("brain_net."):])
+            if bone_value is not None:
+                value = (value + bone_value) / 2
+
+        migrated[key] = value
+
+    if "fc.weight" in state_dict:
+        feat_dim = state_dict["fc.weight"].shape[1] // 2
+    else:
+        feat_dim = state_dict["fc_brain.weight"].shape[1]
+    for adapter in ("brain_adapter", "bone_adapter"):
+        migrated.setdefault(f"{adapter}.0.weight", torch.zeros(feat_dim, feat_dim))
+        migrated.setdefault(f"{adapter}.0.bias", torch.zeros(feat_dim))
+
+    return migrated
+
+
 class DualEfficientNetBinary(nn.Module):
     """
     Stage 1: Binary Hemorrhage Detector
     Dual-branch EfficientNet-B0 (brain + bone)
     Outputs a single logit (we apply sigmoid in inference)
+
+    shared_backbone=True runs both inputs through brain_net in one batched
+    pass (half the kernel launches, half the weights), with a residual
+    adapter per branch. Off by default: the trained checkpoints have
+    separate brain/bone weights (see migrate_checkpoint to convert them).
+
+    inference_only=True replaces the dropout with Identity, so eval-only
+    models (load_models) don't dispatch a no-op dropout per forward.
     """
-    def __init__(self):
+    def __init__(self, shared_backbone=False, inference_only=False):
         super().__init__()
-        # Use EfficientNet-B0 for both branches
-        self.brain_net = models.efficientnet_b0(weights=None)
-        self.bone_net  = models.efficientnet_b0(weights=None)
+        self.shared_backbone = shared_backbone
 
-        # Remove final classifier heads → use features only
-        brain_feat_dim = self.brain_net.classifier[1].in_features
-        bone_feat_dim  = self.bone_net.classifier[1].in_features
+        # EfficientNet-B0 for both branches, features only
+        self.brain_net = _feature_backbone(inference_only)
+        self.bone_net  = _feature_backbone(inference_only)
 
-        # Replace classifiers with Identity
-        self.brain_net.classifier[1] = nn.Identity()
-        self.bone_net.classifier[1]  = nn.Identity()
+        brain_feat_dim = bone_feat_dim = EFFICIENTNET_B0_FEATURES
 
-        fused_dim = brain_feat_dim + bone_feat_dim
+        if shared_backbone:
+            _share_backbone(self, brain_feat_dim)
 
-        self.dropout = nn.Dropout(0.4)
-        self.fc = nn.Linear(fused_dim, 1)  # single logit
+        self.dropout = nn.Identity() if inference_only else nn.Dropout(0.4)
+
+        # fc over [brain | bone], split per branch (see _fc_head)
+        self.fc_brain = nn.Linear(brain_feat_dim, 1)             # single logit
+        self.fc_bone  = nn.Linear(bone_feat_dim, 1, bias=False)
+        self.register_load_state_dict_pre_hook(_split_fc_on_load)
 
     def forward(self, brain_img, bone_img):
         # brain_img, bone_img: [B, 3, H, W]
-        brain_feat = self.brain_net(brain_img)  # [B, F]
-        bone_feat  = self.bone_net(bone_img)    # [B, F]
+        brain_feat, bone_feat = _branch_features(self, brain_img, bone_img)  # [B, F] each
 
-        fused = torch.cat([brain_feat, bone_feat], dim=1)
-        fused = self.dropout(fused)
-        logit = self.fc(fused)                 # [B, 1]
+        logit = _fc_head(self, brain_feat, bone_feat)  # [B, 1]
         return logit.squeeze(1)                # [B]
 
+    def infer(self, brain_host, bone_host):
+        """
+        forward for host-side inputs, through pinned buffers (see infer_pinned)
+        """
+        return infer_pinned(self, brain_host, bone_host)
+
 
 class DualEfficientNetSubtype(nn.Module):
     """
     Stage 2: Multi-label Hemorrhage Subtype Classifier
     Dual-branch EfficientNet-B0 (brain + bone)
     Outputs raw logits for 6 subtypes (sigmoid applied in inference)
+
+    shared_backbone, inference_only: see DualEfficientNetBinary.
     """
-    def __init__(self, num_classes=6):
+    def __init__(self, num_classes=6, shared_backbone=False, inference_only=False):
         super().__init__()
-        self.num_classes = num_classes
+        self.shared_backbone = shared_backbone
 
-        self.brain_net = models.efficientnet_b0(weights=None)
-        self.bone_net  = models.efficientnet_b0(weights=None)
+        self.brain_net = _feature_backbone(inference_only)
+        self.bone_net  = _feature_backbone(inference_only)
 
-        brain_feat_dim = self.brain_net.classifier[1].in_features
-        bone_feat_dim  = self.bone_net.classifier[1].in_features
+        brain_feat_dim = bone_feat_dim = EFFICIENTNET_B0_FEATURES
 
-        self.brain_net.classifier[1] = nn.Identity()
-        self.bone_net.classifier[1]  = nn.Identity()
+        if shared_backbone:
+            _share_backbone(self, brain_feat_dim)
 
-        fused_dim = brain_feat_dim + bone_feat_dim
+        self.dropout = nn.Identity() if inference_only else nn.Dropout(0.4)
 
-        self.dropout = nn.Dropout(0.4)
-        self.fc = nn.Linear(fused_dim, num_classes)  # logits per subtype
+        # logits per subtype, fc split per branch (see _fc_head)
+        self.fc_brain = nn.Linear(brain_feat_dim, num_classes)
+        self.fc_bone  = nn.Linear(bone_feat_dim, num_classes, bias=False)
+        self.register_load_state_dict_pre_hook(_split_fc_on_load)
 
     def forward(self, brain_img, bone_img):
-        brain_feat = self.brain_net(brain_img)
-        bone_feat  = self.bone_net(bone_img)
+        brain_feat, bone_feat = _branch_features(self, brain_img, bone_img)
 
-        fused = torch.cat([brain_feat, bone_feat], dim=1)
-        fused = self.dropout(fused)
-        logits = self.fc(fused)    # [B, num_classes]
+        logits = _fc_head(self, brain_feat, bone_feat)    # [B, num_classes]
         return logits
 
+    def infer(self, brain_host, bone_host):
+        """
+        forward for host-side inputs, through pinned buffers (see infer_pinned)
+        """
+        return infer_pinned(self, brain_host, bone_host)
+
+
+class DualEfficientNetUnified(DualEfficientNetSubtype):
+    """
+    Both stages on one dual-branch backbone: the head has 1 + num_subtypes
+    outputs (hemorrhage logit first), so Stage 2 needs no backbone pass of
+    its own. Requires a checkpoint trained this way; the separately trained
+    detector and classifier can't be merged into it.
+
+    Returns (binary_logit [B], subtype_logits [B, num_subtypes]).
+    """
+    def __init__(self, num_subtypes=6, shared_backbone=False, inference_only=False):
+        super().__init__(1 + num_subtypes, shared_backbone, inference_only)
+        self.num_subtypes = num_subtypes
+
+    def forward(self, brain_img, bone_img):
+        logits = super().forward(brain_img, bone_img)  # [B, 1 + num_subtypes]
+        return logits[:, 0], logits[:, 1:]
+
+
+class UnifiedStage(nn.Module):
+    """
+    Detector (output=0) or classifier (output=1) view of a
+    DualEfficientNetUnified, usable wherever the two-model pipeline expects
+    detector_model / classifier_model.
+
+    The two views share the last no-grad forward: the classifier called on
+    the very tensor objects the detector just ran on reuses its subtype
+    logits. Every classifier call (grad-enabled ones included) clears the
+    cache, and the next detector call replaces it, so it holds at most one
+    batch's logits. The inputs are matched by identity only (held as weak
+    references, so the cache doesn't keep the batch alive): don't refill
+    them in place between the detector and classifier calls. Grad-enabled
+    calls (Grad-CAM) always run the model.
+    """
+    def __init__(self, unified, output, shared_cache):
+        super().__init__()
+        self.unified = unified
+        self.output = output
+        self._cache = shared_cache
+
+    @property
+    def brain_net(self):
+        # Grad-CAM target branch
+        return self.unified.brain_net
+
+    @property
+    def input_dtype(self):
+        # Backbone precision (see cast_backbones, autocast_context)
+        return self.unified.input_dtype
+
+    @property
+    def autocast_dtype(self):
+        return self.unified.autocast_dtype
+
+    def forward(self, brain_img, bone_img):
+        if self.output == 0:
+            outputs = self.unified(brain_img, bone_img)
+            if not torch.is_grad_enabled():
+                self._cache["inputs"] = (weakref.ref(brain_img), weakref.ref(bone_img))
+                self._cache["outputs"] = outputs
+            return outputs[0]
+
+        # Every classifier call consumes the cache, grad-enabled ones included
+        inputs = self._cache.pop("inputs", None)
+        outputs = self._cache.pop("outputs", None)
+        if (not torch.is_grad_enabled() and inputs is not None
+                and inputs[0]() is brain_img and inputs[1]() is bone_img):
+            return outputs[1]
+
+        return self.unified(brain_img, bone_img)[1]
+
+    def infer(self, brain_host, bone_host):
+        """
+        forward for host-side inputs, through pinned buffers (see infer_pinned)
+        """
+        return infer_pinned(self, brain_host, bone_host)
+
 
 # ----------------------------
 #  Loading helpers
 # ----------------------------
-def load_models(device=None):
+def load_models(device=None, precision=None, warmup=True):
     """
     Load both Stage 1 and Stage 2 models with dual-branch EfficientNet.
 
+    precision: "fp32", "fp16" or "bf16" for the backbones (the fc head stays
+    FP32): the detector's weights are cast to it, the classifier keeps FP32
+    weights for Grad-CAM and is autocast to it for no-grad calls.
+    Defaults to "fp16" on CUDA and "fp32" on CPU.
+
+    warmup=False skips the warm-up passes, for callers that run the models
+    on another thread and warm them up there (see DynamicBatcher.warmup).
+
     Returns:
         detector, classifier, device
     """
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    print(f"Loading models on device: {device}")
-
-    # Init architectures that match training
-    detector = DualEfficientNetBinary()
-    classifier = DualEfficientNetSubtype(num_classes=6)
+    if precision is None:
+        precision = "fp16" if device.type == "cuda" else "fp32"
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {list(PRECISIONS)}")
 
     detector_path = MODELS_DIR / "best_dual_model.pth"
     classifier_path = MODELS_DIR / "best_subtype_model.pth"
@@ -113,59 +485,419 @@ def load_models(device=None):
     if not classifier_path.exists():
         raise FileNotFoundError(f"Stage 2 model not found at {classifier_path}")
 
-    # ---- Stage 1 ----
-    print(f"Loading Stage 1 (Detector) from: {detector_path}")
-    det_state = torch.load(detector_path, map_location=device)
+    # Repeat calls reuse the loaded models until a checkpoint changes
+    cache_key = (str(device), precision, os.environ.get("HEMO_INT8"))
+    mtimes = (detector_path.stat().st_mtime, classifier_path.stat().st_mtime)
+    cached = _MODEL_CACHE.get(cache_key)
+    if cached is not None:
+        if cached[0] == mtimes:
+            return cached[1]
+        # A checkpoint changed: release the old models before loading
+        del _MODEL_CACHE[cache_key], cached
+        gc.collect()
 
-    # Support checkpoint dicts or plain state_dicts
-    if isinstance(det_state, dict) and "model_state_dict" in det_state:
-        detector.load_state_dict(det_state["model_state_dict"])
-    else:
-        detector.load_state_dict(det_state)
+    print(f"Loading models on device: {device}")
 
-    # ---- Stage 2 ----
-    print(f"Loading Stage 2 (Subtype Classifier) from: {classifier_path}")
-    cls_state = torch.load(classifier_path, map_location=device)
+    # Init architectures that match training (minus the dropout)
+    detector = DualEfficientNetBinary(inference_only=True)
+    classifier = DualEfficientNetSubtype(num_classes=6, inference_only=True)
 
-    if isinstance(cls_state, dict) and "model_state_dict" in cls_state:
-        classifier.load_state_dict(cls_state["model_state_dict"])
-    else:
-        classifier.load_state_dict(cls_state)
+    # Inputs are always 224x224, so let cuDNN benchmark and cache the
+    # fastest conv algorithms; channels_last suits the depthwise convs.
+    # TF32 covers whatever still runs in FP32 (the fc heads) on Ampere+.
+    if device.type == "cuda":
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
 
-    detector = detector.to(device).eval()
-    classifier = classifier.to(device).eval()
+    # ---- Stage 1 + Stage 2, loaded in parallel ----
+    print(f"Loading Stage 1 (Detector) from: {detector_path}")
+    print(f"Loading Stage 2 (Subtype Classifier) from: {classifier_path}")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        detector_future = pool.submit(load_to_device, detector, detector_path, device)
+        classifier_future = pool.submit(load_to_device, classifier, classifier_path, device)
+        detector, classifier = detector_future.result(), classifier_future.result()
+
+    # Also for fp32: input_dtype tells autocast_context not to autocast.
+    # The classifier keeps FP32 weights since it also runs the Grad-CAM
+    # forward/backward, which stays in FP32; its no-grad Stage 2 calls are
+    # autocast to the requested precision instead.
+    detector = cast_backbones(detector, PRECISIONS[precision])
+    classifier = cast_backbones(classifier, torch.float32)
+    if precision != "fp32":
+        classifier.autocast_dtype = PRECISIONS[precision]
+        print(f"Backbones running in {precision}")
+
+    # Optional INT8 Stage 1 on CPU; HEMO_INT8 points at calibration images
+    calibration_dir = os.environ.get("HEMO_INT8")
+    if calibration_dir and device.type == "cpu" and precision == "fp32":
+        calibration_inputs = load_calibration_inputs(calibration_dir)
+        if calibration_inputs:
+            detector = quantize_for_cpu(detector, calibration_inputs)
+            print(f"✓ Stage 1 quantized to INT8 ({len(calibration_inputs)} calibration images)")
+        else:
+            print(f"⚠ No calibration images in {calibration_dir}, skipping INT8")
+
+    # Prebuilt TensorRT engines (see trt_engine.py) replace the PyTorch
+    # forward when present; otherwise compile / CUDA-graph the models
+    detector, classifier = load_trt_engines(
+        detector, classifier, device,
+        MODELS_DIR / "best_dual_model.plan", MODELS_DIR / "best_subtype_model.plan"
+    )
+    detector, classifier = compile_models(detector, classifier, device)
+    detector, classifier = build_graphed_runners(detector, classifier, device)
+
+    # Warm-up passes (fills the cuDNN benchmark cache) so the first request
+    # runs at steady-state latency
+    if warmup:
+        from inference import warmup_pipeline
+        try:
+            warmup_pipeline(detector, classifier, device)
+        except Exception as e:
+            print(f"⚠ Warm-up failed: {e}")
 
     print("✓ Models loaded successfully!")
 
+    _MODEL_CACHE[cache_key] = (mtimes, (detector, classifier, device))
     return detector, classifier, device
 
 
+def load_unified_model(device=None, path=None, precision=None):
+    """
+    Load a DualEfficientNetUnified checkpoint (default:
+    Saved Models/best_unified_model.pth) as detector/classifier views of
+    the one model. precision: see load_models.
+
+    Returns:
+        detector, classifier, device
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if precision is None:
+        precision = "fp16" if device.type == "cuda" else "fp32"
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {list(PRECISIONS)}")
+
+    path = Path(path) if path is not None else MODELS_DIR / "best_unified_model.pth"
+    if not path.exists():
+        raise FileNotFoundError(f"Unified model not found at {path}")
+
+    print(f"Loading unified model from: {path}")
+    unified = load_to_device(DualEfficientNetUnified(inference_only=True), path, device)
+
+    # FP32 weights + autocast, as for load_models' classifier (Grad-CAM)
+    unified = cast_backbones(unified, torch.float32)
+    if precision != "fp32":
+        unified.autocast_dtype = PRECISIONS[precision]
+
+    cache = {}
+    return UnifiedStage(unified, 0, cache), UnifiedStage(unified, 1, cache), device
+
+
+def load_state(model, path, mmap=False):
+    """
+    Load a checkpoint into model; supports checkpoint dicts or plain state_dicts.
+
+    The checkpoint tensors become the model's parameters (assign=True).
+    With mmap=True the file is memory-mapped instead of read, so no staging
+    copy of the weights is made, but the parameters stay backed by the file
+    until the model is copied elsewhere (only use it when the caller moves
+    the model to another device right away).
+    """
+    state = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+
+    if isinstance(state, dict) and "model_state_dict" in state:
+        model.load_state_dict(state["model_state_dict"], assign=True)
+    else:
+        model.load_state_dict(state, assign=True)
+
+    # Don't keep the checkpoint dict (and any optimizer state in it) alive
+    del state
+    gc.collect()
+
+
+def load_to_device(model, path, device):
+    """
+    load_state, then move the model to device (channels_last) in eval mode.
+    On CUDA the checkpoint is memory-mapped (the H2D copy detaches the
+    weights from the file) and the copy runs on its own stream, so two
+    models loading from parallel threads overlap their H2D transfers.
+    On CPU it is read into memory: mapped parameters would change whenever
+    the checkpoint file is overwritten.
+    """
+    load_state(model, path, mmap=device.type == "cuda")
+
+    if device.type != "cuda":
+        return model.to(device, memory_format=torch.channels_last).eval()
+
+    stream = torch.cuda.Stream(device)
+    with torch.cuda.stream(stream):
+        model = model.to(device, memory_format=torch.channels_last, non_blocking=True)
+    stream.synchronize()
+    return model.eval()
+
+
+def cast_backbones(model, dtype):
+    """
+    Cast a dual-branch model to dtype except for its fc head, which stays
+    FP32 so the logits don't drift. input_dtype records the precision, so
+    the inference calls run the model without autocast (see
+    inference.autocast_context).
+    """
+    model.to(dtype)
+    model.fc_brain.float()
+    model.fc_bone.float()
+    model.input_dtype = dtype
+    return model
+
+
+def load_calibration_inputs(folder, max_images=500):
+    """
+    Preprocessed [1, 3, 224, 224] tensors for the PNG/JPEG images in folder,
+    used to calibrate INT8 quantization.
+    """
+    from inference import preprocess_image
+
+    paths = sorted(p for p in Path(folder).glob("*")
+                   if p.suffix.lower() in (".png", ".jpg", ".jpeg"))[:max_images]
+
+    return [preprocess_image(path)[0][0] for path in paths]
+
+
+def quantize_for_cpu(model, calibration_inputs):
+    """
+    INT8 post-training static quantization of the EfficientNet backbones
+    (FX graph mode, x86/fbgemm kernels). Conv+BN pairs are folded and
+    activation ranges are observed on calibration_inputs; ops without INT8
+    kernels (SiLU, the SE sigmoid gates) stay in float. The fc head stays
+    FP32.
+
+    The result is inference-only (no autograd), so it is applied to the
+    detector; Grad-CAM needs the float classifier.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = "x86"
+    qconfig_mapping = get_default_qconfig_mapping("x86")
+    example = calibration_inputs[0].contiguous(memory_format=torch.channels_last)
+
+    for name in ("brain_net", "bone_net"):
+        if not hasattr(model, name):  # shared_backbone models have no bone_net
+            continue
+
+        prepared = prepare_fx(getattr(model, name), qconfig_mapping, (example,))
+        with torch.inference_mode():
+            for x in calibration_inputs:
+                prepared(x.contiguous(memory_format=torch.channels_last))
+        setattr(model, name, convert_fx(prepared))
+
+    return model
+
+
+def _compile_disabled():
+    """
+    HEMO_DISABLE_COMPILE=1 keeps the eager models: no torch.compile, no
+    CUDA graphs
+    """
+    return os.environ.get("HEMO_DISABLE_COMPILE", "0") not in ("", "0")
+
+
+def compile_models(detector, classifier, device):
+    """
+    torch.compile both models for 3x224x224 inputs, with one dummy pass per
+    COMPILE_BATCH_SIZES entry so no request (single or batched by
+    DynamicBatcher) pays for a compile. Falls back to the eager models on
+    torch<2.0 or compile errors.
+
+    The CUDA graphs are recorded per thread on the following calls, so the
+    thread serving the requests warms the models up itself
+    (warmup_pipeline, DynamicBatcher.warmup).
+
+    CUDA only (reduce-overhead relies on CUDA graphs); set
+    HEMO_DISABLE_COMPILE=1 to keep the eager models for debugging.
+    """
+    if not hasattr(torch, "compile") or device.type != "cuda":
+        return detector, classifier
+    if hasattr(detector, "_orig_mod"):  # already wrapped (TensorRT)
+        return detector, classifier
+    if _compile_disabled():
+        print("torch.compile disabled (HEMO_DISABLE_COMPILE)")
+        return detector, classifier
+
+    # Compile through the real inference functions so the compiled graphs
+    # are specialised for the same grad/autocast/layout state.
+    from inference import stage1_batch, stage2_batch
+
+    try:
+        compiled_detector = StaticBatchModule(
+            torch.compile(detector, mode="reduce-overhead", dynamic=False))
+        compiled_classifier = StaticBatchModule(
+            torch.compile(classifier, mode="reduce-overhead", dynamic=False))
+
+        for batch_size in COMPILE_BATCH_SIZES:
+            dummy = torch.zeros(batch_size, 3, 224, 224)
+            stage1_batch(compiled_detector, dummy, dummy, device)
+            stage2_batch(compiled_classifier, dummy, dummy, device)
+    except Exception as e:
+        print(f"⚠ torch.compile failed, using eager models: {e}")
+        return detector, classifier
+
+    print("✓ Models compiled with torch.compile")
+    return compiled_detector, compiled_classifier
+
+
+class StaticBatchModule(nn.Module):
+    """
+    Pads the batch dim up to the next COMPILE_BATCH_SIZES entry before
+    calling a torch.compile'd model (dynamic=False) and drops the padded
+    rows from the output. DynamicBatcher's varying batch sizes then map to a
+    handful of specialised graphs (each compiled on first use) instead of
+    recompiling per size until dynamo's recompile limit falls back to eager.
+    """
+    def __init__(self, compiled):
+        super().__init__()
+        self.compiled = compiled
+
+    @property
+    def _orig_mod(self):
+        return self.compiled._orig_mod
+
+    def forward(self, brain_img, bone_img):
+        batch = brain_img.shape[0]
+        size = next((s for s in COMPILE_BATCH_SIZES if s >= batch), batch)
+        if size == batch:
+            return self.compiled(brain_img, bone_img)
+
+        shared = bone_img is brain_img
+        padding = brain_img.new_zeros((size - batch,) + tuple(brain_img.shape[1:]))
+        brain_img = torch.cat([brain_img, padding])
+        bone_img = brain_img if shared else torch.cat([bone_img, padding])
+
+        return self.compiled(brain_img, bone_img)[:batch]
+
+    def infer(self, brain_host, bone_host):
+        """
+        forward for host-side inputs, through pinned buffers (see infer_pinned)
+        """
+        return infer_pinned(self, brain_host, bone_host)
+
+
+# ----------------------------
+#  CUDA graphs
+# ----------------------------
+class GraphedInference(nn.Module):
+    """
+    Replays a CUDA graph of model's forward for inputs of one fixed shape
+    (a single-image request): new pixels are copied into static input
+    buffers and the whole kernel sequence is launched with one call.
+
+    Other shapes, and calls with grad enabled, run the eager model. The graph
+    is captured under inference_mode + autocast_context, matching the
+    Stage 1 / Stage 2 inference calls.
+    """
+    def __init__(self, model, device, shape=(1, 3, 224, 224), warmup=3):
+        super().__init__()
+        # Same attribute as torch.compile's wrapper, so code that needs the
+        # eager module (Grad-CAM) unwraps either one
+        self._orig_mod = model
+
+        self.static_brain = torch.zeros(shape, device=device).contiguous(memory_format=torch.channels_last)
+        self.static_bone = torch.zeros_like(self.static_brain)
+        self.graph = torch.cuda.CUDAGraph()
+
+        from inference import autocast_context
+
+        # Autocast's weight cast cache has to be off while capturing
+        with torch.inference_mode(), autocast_context(device, model, cache_enabled=False):
+            # Warm up on a side stream (cuBLAS/cuDNN init must not be captured)
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup):
+                    model(self.static_brain, self.static_bone)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            with torch.cuda.graph(self.graph):
+                self.static_out = model(self.static_brain, self.static_bone)
+
+    def forward(self, brain_img, bone_img):
+        if brain_img.shape != self.static_brain.shape or torch.is_grad_enabled():
+            return self._orig_mod(brain_img, bone_img)
+
+        self.static_brain.copy_(brain_img, non_blocking=True)
+        self.static_bone.copy_(bone_img, non_blocking=True)
+        self.graph.replay()
+        return self.static_out.clone()  # the static output is overwritten by the next replay
+
+    def infer(self, brain_host, bone_host):
+        """
+        forward for host-side inputs, through pinned buffers (see infer_pinned)
+        """
+        return infer_pinned(self, brain_host, bone_host)
+
+
+def build_graphed_runners(detector, classifier, device, shape=(1, 3, 224, 224)):
+    """
+    Wrap both models in GraphedInference. Skipped off CUDA, with
+    HEMO_DISABLE_COMPILE set, and for models already compiled
+    (reduce-overhead mode uses CUDA graphs itself); falls back to the eager
+    models if capture fails.
+    """
+    if device.type != "cuda" or hasattr(detector, "_orig_mod") or _compile_disabled():
+        return detector, classifier
+
+    try:
+        graphed_detector = GraphedInference(detector, device, shape)
+        graphed_classifier = GraphedInference(classifier, device, shape)
+    except Exception as e:
+        print(f"⚠ CUDA graph capture failed, using eager models: {e}")
+        return detector, classifier
+
+    print("✓ Models captured in CUDA graphs")
+    return graphed_detector, graphed_classifier
+
+
+# Built once at import; get_model_info is called on every /api/model-info
+MODEL_INFO = {
+    "stage1": {
+        "name": "Hemorrhage Detector",
+        "architecture": "Dual EfficientNet-B0 (brain + bone)",
+        "output": "Binary (Hemorrhage / No Hemorrhage)",
+        "path": str(MODELS_DIR / "best_dual_model.pth"),
+    },
+    "stage2": {
+        "name": "Subtype Classifier",
+        "architecture": "Dual EfficientNet-B0 (brain + bone)",
+        "output": "Multi-label (6 subtypes)",
+        "subtypes": [
+            "Intraventricular",
+            "Intraparenchymal",
+            "Subarachnoid",
+            "Epidural",
+            "Subdural",
+            "Skull Fracture",
+        ],
+        "path": str(MODELS_DIR / "best_subtype_model.pth"),
+    },
+}
+
+
+def count_parameters(model):
+    """
+    Number of parameters of a model (of the eager model for wrapped ones).
+    Buffers such as BatchNorm running stats are not counted.
+    """
+    model = getattr(model, "_orig_mod", model)
+    return sum(p.numel() for p in model.parameters())
+
+
 def get_model_info():
     """
-    Info for the frontend / API
-    """
-    return {
-        "stage1": {
-            "name": "Hemorrhage Detector",
-            "architecture": "Dual EfficientNet-B0 (brain + bone)",
-            "output": "Binary (Hemorrhage / No Hemorrhage)",
-            "path": str(MODELS_DIR / "best_dual_model.pth"),
-        },
-        "stage2": {
-            "name": "Subtype Classifier",
-            "architecture": "Dual EfficientNet-B0 (brain + bone)",
-            "output": "Multi-label (6 subtypes)",
-            "subtypes": [
-                "Intraventricular",
-                "Intraparenchymal",
-                "Subarachnoid",
-                "Epidural",
-                "Subdural",
-                "Skull Fracture",
-            ],
-            "path": str(MODELS_DIR / "best_subtype_model.pth"),
-        },
-    }
+    Info for the frontend / API (a shallow copy, so callers can add keys)
+    """
+    return dict(MODEL_INFO)
 
 
 if __name__ == "__main__":
@@ -175,7 +907,13 @@ if __name__ == "__main__":
         print("MODEL LOADING TEST SUCCESSFUL")
         print("=" * 50)
         print(f"Device: {dev}")
-        print(f"Detector params : {sum(p.numel() for p in det.parameters()):,}")
-        print(f"Classifier params: {sum(p.numel() for p in cls.parameters()):,}")
+        print(f"Detector params : {count_parameters(det):,}")
+        print(f"Classifier params: {count_parameters(cls):,}")
+
+        # Forward under autocast, as the inference calls run it on CUDA
+        dummy = torch.zeros(1, 3, 224, 224, device=dev)
+        autocast_dtype = torch.float16 if dev.type == "cuda" else torch.bfloat16
+        with torch.inference_mode(), torch.autocast(dev.type, dtype=autocast_dtype):
+            print(f"Autocast forward: {tuple(det(dummy, dummy).shape)} / {tuple(cls(dummy, dummy).shape)}")
     except Exception as e:
         print(f"\n❌ Error loading models: {e}")
\ No newline at end of file
@@ -140,33 +140,15 @@ async function runAnalysis() {
         resultsSection.style.display = 'none';
         analyzeBtn.disabled = true;
         
-        // Upload file
+        // Upload + analyze in a single request
         const formData = new FormData();
         formData.append('file', currentFile);
         
-        const uploadResponse = await fetch('/api/upload', {
+        const analysisResponse = await fetch('/api/detect', {
             method: 'POST',
             body: formData
         });
         
-        if (!uploadResponse.ok) {
-            const error = await uploadResponse.json();
-            throw new Error(error.error || 'Upload failed');
-        }
-        
-        const uploadData = await uploadResponse.json();
-        
-        // Run analysis
-        const analysisResponse = await fetch('/api/analyze', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                filename: uploadData.filename
-            })
-        });
-        
         if (!analysisResponse.ok) {
             const error = await analysisResponse.json();
             throw new Error(error.error || 'Analysis failed');
@@ -201,7 +183,7 @@ function displayResults(data) {
         'result-value ' + (results.hemorrhage_detected ? 'positive' : 'negative');
     
     document.getElementById('detectionProbability').textContent = 
-        results.detection_probability;
+        formatPercent(results.detection_probability);
     
     const confidenceBadge = document.getElementById('confidenceBadge');
     confidenceBadge.textContent = results.detection_confidence;
@@ -221,7 +203,7 @@ function displayResults(data) {
             item.className = 'subtype-item';
             item.innerHTML = `
                 <span class="subtype-name">📍 ${subtype.name}</span>
-                <span class="subtype-probability">${subtype.probability}</span>
+                <span class="subtype-probability">${formatPercent(subtype.probability)}</span>
             `;
             subtypesList.appendChild(item);
         });
@@ -244,9 +226,11 @@ function displayResults(data) {
                 <img src="${item.image_url}" alt="${item.subtype} Grad-CAM" 
                      class="gradcam-image" onclick="openImageModal('${item.image_url}')">
                 <div class="gradcam-label">
-                    ${item.subtype} (${(item.probability * 100).toFixed(2)}%)
+                    ${item.subtype} (${formatPercent(item.probability)})
                 </div>
             `;
+            // Overlays are written in the background; retry until they exist
+            retryImage(card.querySelector('.gradcam-image'));
             gradcamGrid.appendChild(card);
         });
     } else {
@@ -260,6 +244,20 @@ function displayResults(data) {
     resultsSection.scrollIntoView({ behavior: 'smooth', block: 'start' });
 }
 
+/**
+ * Reload an image a few times if it is not available yet
+ */
+function retryImage(img, attempts = 10, delayMs = 200) {
+    let tries = 0;
+    const src = img.getAttribute('src');
+    img.addEventListener('error', () => {
+        if (tries++ >= attempts) return;
+        setTimeout(() => {
+            img.src = `${src}?retry=${tries}`;
+        }, delayMs);
+    });
+}
+
 /**
  * Open image in modal (for zooming)
  */
@@ -328,6 +326,13 @@ function formatBytes(bytes) {
     return Math.round(bytes / Math.pow(k, i) * 100) / 100 + ' ' + sizes[i];
 }
 
+/**
+ * Format a 0-1 probability as a percentage
+ */
+function formatPercent(probability) {
+    return (probability * 100).toFixed(2) + '%';
+}
+
 /**
  * Download results as JSON
  */
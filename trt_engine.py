@@ -0,0 +1,161 @@
+"""
+TensorRT Engines for the Dual-Branch Models
+ONNX export + trtexec engine build, and a runtime wrapper with the same
+(brain_img, bone_img) -> logits interface as the PyTorch models
+"""
+
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    import tensorrt as trt
+except ImportError:
+    trt = None
+
+# Engines take batches of 1..ENGINE_MAX_BATCH 3x224x224 images (one
+# optimisation profile, tuned for the single-image ENGINE_INPUT_SHAPE).
+# ENGINE_MAX_BATCH matches the app's BATCH_MAX_SIZE.
+ENGINE_INPUT_SHAPE = (1, 3, 224, 224)
+ENGINE_MAX_BATCH = 16
+
+
+def export_trt(model, sample_brain, sample_bone, out_path, precision="fp16"):
+    """
+    Export model to ONNX with a dynamic batch dim (saved next to out_path)
+    and build a TensorRT engine from it with trtexec, for batches of 1 to
+    ENGINE_MAX_BATCH.
+    """
+    out_path = Path(out_path)
+    onnx_path = out_path.with_suffix(".onnx")
+
+    model = getattr(model, "_orig_mod", model).eval()
+    with torch.no_grad():
+        torch.onnx.export(model, (sample_brain, sample_bone), str(onnx_path),
+                          input_names=["brain_img", "bone_img"],
+                          output_names=["logits"], opset_version=18,
+                          dynamic_axes={"brain_img": {0: "batch"}, "bone_img": {0: "batch"},
+                                        "logits": {0: "batch"}})
+
+    image_shape = "x".join(str(dim) for dim in ENGINE_INPUT_SHAPE[1:])
+
+    def shapes(batch):
+        return f"brain_img:{batch}x{image_shape},bone_img:{batch}x{image_shape}"
+
+    cmd = ["trtexec", f"--onnx={onnx_path}", f"--saveEngine={out_path}",
+           f"--minShapes={shapes(1)}", f"--optShapes={shapes(ENGINE_INPUT_SHAPE[0])}",
+           f"--maxShapes={shapes(ENGINE_MAX_BATCH)}"]
+    if precision == "fp16":
+        cmd.append("--fp16")
+    subprocess.run(cmd, check=True)
+
+    return out_path
+
+
+class TRTInference(nn.Module):
+    """
+    Runs a serialized TensorRT engine on the current CUDA stream, for any
+    batch size its optimisation profile covers (engines built before the
+    dynamic batch dim only take their one static shape).
+
+    Other inputs, and calls with grad enabled, go to the eager model, kept
+    as _orig_mod (like torch.compile's wrapper) so Grad-CAM still hooks the
+    PyTorch module.
+    """
+    def __init__(self, engine_path, model, device):
+        super().__init__()
+        self._orig_mod = model
+
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, "rb") as f:
+            self.engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+        if self.engine is None:
+            raise RuntimeError(f"Could not deserialize {engine_path}")
+        self.context = self.engine.create_execution_context()
+
+        # Largest batch the engine takes; a dynamic batch dim reads as -1
+        input_shape = tuple(self.engine.get_tensor_shape("brain_img"))
+        self.dynamic_batch = input_shape[0] == -1
+        self.max_batch = (self.engine.get_tensor_profile_shape("brain_img", 0)[2][0]
+                          if self.dynamic_batch else input_shape[0])
+
+        # Static I/O buffers sized for max_batch, bound once; smaller
+        # batches use their leading rows
+        self.buffers = {}
+        for i in range(self.engine.num_io_tensors):
+            name = self.engine.get_tensor_name(i)
+            dtype = torch.from_numpy(
+                np.empty(0, dtype=trt.nptype(self.engine.get_tensor_dtype(name)))
+            ).dtype
+            shape = (self.max_batch,) + tuple(self.engine.get_tensor_shape(name))[1:]
+            self.buffers[name] = torch.empty(shape, dtype=dtype, device=device)
+            self.context.set_tensor_address(name, self.buffers[name].data_ptr())
+
+    def forward(self, brain_img, bone_img):
+        batch = brain_img.shape[0]
+        brain_buf = self.buffers["brain_img"]
+        supported = (batch <= self.max_batch if self.dynamic_batch else batch == self.max_batch)
+        if brain_img.shape[1:] != brain_buf.shape[1:] or not supported or torch.is_grad_enabled():
+            return self._orig_mod(brain_img, bone_img)
+
+        brain_buf[:batch].copy_(brain_img)
+        self.buffers["bone_img"][:batch].copy_(bone_img)
+        if self.dynamic_batch:
+            self.context.set_input_shape("brain_img", tuple(brain_img.shape))
+            self.context.set_input_shape("bone_img", tuple(brain_img.shape))
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+        return self.buffers["logits"][:batch].clone()
+
+    def infer(self, brain_host, bone_host):
+        """
+        forward for host-side inputs, through pinned buffers (see model_utils.infer_pinned)
+        """
+        from model_utils import infer_pinned
+        return infer_pinned(self, brain_host, bone_host)
+
+
+def load_trt_engines(detector, classifier, device, detector_path, classifier_path):
+    """
+    Wrap both models in TRTInference when running on CUDA, TensorRT is
+    installed and both engines exist and are newer than their checkpoints
+    (the .pth next to each .plan); otherwise return the PyTorch models.
+    """
+    if device.type != "cuda" or trt is None:
+        return detector, classifier
+    if not (Path(detector_path).exists() and Path(classifier_path).exists()):
+        return detector, classifier
+
+    for engine_path in (Path(detector_path), Path(classifier_path)):
+        checkpoint_path = engine_path.with_suffix(".pth")
+        if checkpoint_path.exists() and engine_path.stat().st_mtime < checkpoint_path.stat().st_mtime:
+            print(f"⚠ {engine_path.name} is older than {checkpoint_path.name}, using PyTorch "
+                  f"models (rebuild the engines with trt_engine.py)")
+            return detector, classifier
+
+    try:
+        trt_detector = TRTInference(detector_path, detector, device)
+        trt_classifier = TRTInference(classifier_path, classifier, device)
+    except Exception as e:
+        print(f"⚠ Could not load TensorRT engines, using PyTorch models: {e}")
+        return detector, classifier
+
+    print("✓ TensorRT engines loaded")
+    return trt_detector, trt_classifier
+
+
+if __name__ == "__main__":
+    # Build both engines from the saved checkpoints
+    from model_utils import MODELS_DIR, DualEfficientNetBinary, DualEfficientNetSubtype, load_state
+
+    device = torch.device("cuda")
+    sample_brain = torch.zeros(ENGINE_INPUT_SHAPE, device=device)
+    sample_bone = torch.zeros(ENGINE_INPUT_SHAPE, device=device)
+
+    for model, name in ((DualEfficientNetBinary(), "best_dual_model"),
+                        (DualEfficientNetSubtype(num_classes=6), "best_subtype_model")):
+        load_state(model, MODELS_DIR / f"{name}.pth")
+        export_trt(model.to(device), sample_brain, sample_bone, MODELS_DIR / f"{name}.plan")
+        print(f"✓ Built {name}.plan")